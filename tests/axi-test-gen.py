@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # 
 # Copyright 2018 Mohammad Amin Nili
 # 
@@ -106,7 +106,7 @@ def generate_AXI_Test_File(input_path, output_path):
     f_out.close()
 
 if len(sys.argv) < 4:
-    print 'Usage: axi-test-gen <output file> <input file> <addresses to print>'
+    print('Usage: axi-test-gen <output file> <input file> <addresses to print>')
     sys.exit(1)
 
 asmFile = sys.argv[2].split(".")[0] + ".asm"
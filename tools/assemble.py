@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # 
 # Copyright 2013 Jeff Bush
 # 
@@ -15,9 +15,12 @@
 # limitations under the License.
 # 
 
-import shlex, sys
+import array, re, sys
+from collections import defaultdict
 
 class AssembleError(Exception):
+    __slots__ = ('lineno', 'msg')
+
     def __init__(self, msg, lineno = -1):
         self.lineno = lineno
         self.msg = msg
@@ -25,15 +28,27 @@ class AssembleError(Exception):
     def __str__(self):
         return str(self.lineno) + ': ' + self.msg
 
-class CodeBuilder:
+class CodeBuilder(object):
+    __slots__ = ('pending', 'code', 'labels', 'currentPc')
+
     FIXUP_UNCONDITIONAL = 0     # Unconditional branch instruction
     FIXUP_CONDITIONAL = 1       # Conditional branch instruciton
     FIXUP_LEA = 2               # LEA pseudo op (LUI/ADDI combo)
     FIXUP_LABEL_ADDR = 3        # Label address as data (res)
 
+    HEX_WORDS_PER_WRITE = 0x10000 // 5  # Roughly 64k of output per write
+
+    # Precomputed encodings of the signed 7 bit immediate fields, indexed
+    # by value + 64. LOAD and ADDI share the same field in bits 12:6.
+    STORE_OFFSET_FIELD = [ (((offset >> 3) & 0xf) << 9) | (offset & 7)
+        for offset in range(-64, 64) ]
+    IMMEDIATE_FIELD = [ (value & 0x7f) << 6 for value in range(-64, 64) ]
+
     def __init__(self):
-        self.fixups = []
-        self.code = []
+        # Forward references to labels that are not defined yet:
+        # label -> [ ( type, codeOffset, address, lineno ), ... ]
+        self.pending = defaultdict(list)
+        self.code = array.array('H')
         self.labels = {}
         self.currentPc = 0
 
@@ -44,20 +59,33 @@ class CodeBuilder:
         self.currentPc = where
 
     def _emit(self, type, instr):
-        self.emitData((type << 13) | instr)
+        # Appends directly rather than going through emitData, since this
+        # is called once for every instruction.
+        self.code.append(((type << 13) | instr) & 0xffff)
+        self.currentPc += 1
 
     def emitData(self, value):
-        self.code += [ value ]
+        # Accept either a signed or an unsigned 16 bit value
+        if value > 0xffff or value < -0x8000:
+            raise AssembleError('data value out of range ' + str(value))
+
+        self.code.append(value & 0xffff)
         self.currentPc += 1
 
     def emitArith(self, operation, dest, opa, opb):
         self._emit(0, (operation << 9) | (opb << 6) | (opa << 3) | dest)
         
     def emitLoad(self, dest, ptr, offset):
-        self._emit(1, (offset << 6) | (ptr << 3) | dest)
+        if offset > 63 or offset < -64:
+            raise AssembleError('offset out of range ' + str(offset))
+
+        self._emit(1, self.IMMEDIATE_FIELD[offset + 64] | (ptr << 3) | dest)
         
     def emitStore(self, src, ptr, offset):
-        self._emit(2, (((offset >> 3) & 0xf) << 9) | (src << 6) | (ptr << 3) | (offset & 7))
+        if offset > 63 or offset < -64:
+            raise AssembleError('offset out of range ' + str(offset))
+
+        self._emit(2, self.STORE_OFFSET_FIELD[offset + 64] | (src << 6) | (ptr << 3))
 
     def emitRegisterBranch(self, reg, link):
         self._emit(7, (link << 12) | (reg << 6))
@@ -72,71 +100,170 @@ class CodeBuilder:
         if value > 63 or value < -63:
             raise AssembleError('immediate value out of range ' + str(value))
 
-        self._emit(3, ((value & 0x7f) << 6) | (opa << 3) | dest)
+        self._emit(3, self.IMMEDIATE_FIELD[value + 64] | (opa << 3) | dest)
 
     def emitUnconditionalBranch(self, lineno, target, link):
-        self.fixups += [ ( self.FIXUP_UNCONDITIONAL, len(self.code), self.getPc(), target, lineno ) ]
+        codeOffset = len(self.code)
+        address = self.getPc()
         self._emit(6, (link << 12))
+        self._addFixup(self.FIXUP_UNCONDITIONAL, codeOffset, address, target, lineno)
 
     def emitConditionalBranch(self, lineno, target, condition):
-        self.fixups += [ ( self.FIXUP_CONDITIONAL, len(self.code), self.getPc(), target, lineno ) ]
+        codeOffset = len(self.code)
+        address = self.getPc()
         self._emit(5, (condition << 10))
+        self._addFixup(self.FIXUP_CONDITIONAL, codeOffset, address, target, lineno)
         
     def emitLabel(self, label):
         if label in self.labels:
             raise AssembleError('redefined label ' + str(label))
     
-        self.labels[label] = self.getPc()
+        targetAddress = self.getPc()
+        self.labels[label] = targetAddress
+
+        # Back-patch any earlier references to this label
+        references = self.pending.pop(label, None)
+        if references:
+            handlers = self.FIXUP_HANDLERS
+            for type, codeOffset, address, lineno in references:
+                handlers[type](self, codeOffset, address, targetAddress, lineno)
 
     def emitLea(self, lineno, reg, target):
-        self.fixups += [ ( self.FIXUP_LEA, len(self.code), self.getPc(), target, lineno ) ]
+        codeOffset = len(self.code)
+        address = self.getPc()
         self.emitLui(reg, 0)
         self.emitAddi(reg, reg, 0)
+        self._addFixup(self.FIXUP_LEA, codeOffset, address, target, lineno)
 
     def emitLabelDataRef(self, lineno, target):
-        self.fixups += [ ( self.FIXUP_LABEL_ADDR, len(self.code), self.getPc(), target, lineno ) ]
+        codeOffset = len(self.code)
+        address = self.getPc()
         self.emitData(0)
+        self._addFixup(self.FIXUP_LABEL_ADDR, codeOffset, address, target, lineno)
 
     def getPc(self):
         return self.currentPc
 
-    def doFixups(self):
-        for type, codeOffset, address, label, lineno in self.fixups:
-            if label not in self.labels:
-                raise AssembleError('unknown label ' + label, lineno)
-        
-            targetAddress = self.labels[label]
-            offset = targetAddress - address - 1
-            if type == self.FIXUP_LEA:
-                # LUI followed by ADDI
-                self.code[codeOffset] |= (((targetAddress >> 6) & 0x3ff) << 3) 
-                self.code[codeOffset + 1] |= ((targetAddress & 0x3f) << 6)
-            elif type == self.FIXUP_LABEL_ADDR:
-                # Label address emitted as data (lookup table)
-                self.code[codeOffset] = targetAddress
-            elif type == self.FIXUP_UNCONDITIONAL:
-                if offset > 0x7fff or offset < -0x7fff:
-                    raise AssembleError('fixup out of range', lineno)
-                    
-                self.code[codeOffset] = (self.code[codeOffset] & ~0xfff) | (offset & 0xfff)
-            else:
-                assert type == self.FIXUP_CONDITIONAL
-                if offset > 0x1ff or offset < -0x1ff:
-                    raise AssembleError('fixup out of range', lineno)
+    def _addFixup(self, type, codeOffset, address, label, lineno):
+        # If the label is already defined (backward reference), patch the
+        # instruction now. Otherwise defer it until the label is emitted.
+        labels = self.labels
+        if label in labels:
+            self.FIXUP_HANDLERS[type](self, codeOffset, address, labels[label], lineno)
+        else:
+            self.pending[label].append(( type, codeOffset, address, lineno ))
+
+    def _fixupUnconditional(self, codeOffset, address, targetAddress, lineno):
+        offset = targetAddress - address - 1
+        if offset > 0x7fff or offset < -0x7fff:
+            raise AssembleError('fixup out of range', lineno)
+
+        code = self.code
+        code[codeOffset] = (code[codeOffset] & ~0xfff) | (offset & 0xfff)
+
+    def _fixupConditional(self, codeOffset, address, targetAddress, lineno):
+        offset = targetAddress - address - 1
+        if offset > 0x1ff or offset < -0x1ff:
+            raise AssembleError('fixup out of range', lineno)
+
+        code = self.code
+        code[codeOffset] = (code[codeOffset] & ~0x3ff) | (offset & 0x3ff)
 
-                self.code[codeOffset] = (self.code[codeOffset] & ~0x3ff) | (offset & 0x3ff)
+    def _fixupLea(self, codeOffset, address, targetAddress, lineno):
+        # LUI followed by ADDI
+        code = self.code
+        code[codeOffset] |= (((targetAddress >> 6) & 0x3ff) << 3) 
+        code[codeOffset + 1] |= ((targetAddress & 0x3f) << 6)
+
+    def _fixupLabelAddr(self, codeOffset, address, targetAddress, lineno):
+        # Label address emitted as data (lookup table)
+        if targetAddress > 0xffff:
+            raise AssembleError('label address out of range', lineno)
+
+        self.code[codeOffset] = targetAddress
+
+    # Indexed by FIXUP_* type
+    FIXUP_HANDLERS = [
+        _fixupUnconditional,
+        _fixupConditional,
+        _fixupLea,
+        _fixupLabelAddr
+    ]
+
+    def doFixups(self):
+        # All references are patched as their labels are emitted, so
+        # anything still pending refers to a label that was never defined.
+        # Report the earliest one.
+        if self.pending:
+            lineno, label = min((references[0][3], label)
+                for label, references in self.pending.items())
+            raise AssembleError('unknown label ' + label, lineno)
 
     def dumpHex(self, outputStream):
-        for x in self.code:
-            outputStream.write('%04x\n' % x)
+        # Batch the output, but in bounded chunks so a large image
+        # doesn't have to be formatted into one huge string.
+        code = self.code
+        for start in range(0, len(code), self.HEX_WORDS_PER_WRITE):
+            chunk = code[start:start + self.HEX_WORDS_PER_WRITE]
+            outputStream.write(''.join('%04x\n' % x for x in chunk))
+
+class TokenStream(object):
+    __slots__ = ('tokens', 'pos')
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def advance(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def getLineno(self):
+        # Line number of the most recently consumed token
+        return self.tokens[self.pos - 1][2]
 
 class Parser:
+    # Master token pattern. Whitespace, newlines and comments are matched so
+    # the scan never skips input, but are not emitted as tokens. A run of
+    # blanks and a trailing comment are consumed as a single match.
+    TOKEN_RE = re.compile(r'''
+        (?P<ws>(?:[ \t\r]+|\#[^\n]*)+)
+        |(?P<nl>\n)
+        |(?P<hex>0x[0-9a-fA-F]+)
+        |(?P<num>-?\d+)
+        |(?P<reg>r[0-7](?![\w:-]))
+        |(?P<id>[A-Za-z_][\w-]*:?)
+        |(?P<punct>[(),])
+        |(?P<bad>.)
+    ''', re.VERBOSE)
+
     def __init__(self, stream):
-        self.lexer = shlex.shlex(stream)
-        self.lexer.commenters = '#'
-        self.lexer.wordchars += '_:-'
+        # The whole input is read and tokenized here, so the caller can
+        # close the stream as soon as the parser is constructed.
+        self.tokens = TokenStream(self._tokenize(stream.read()))
         self.builder = None
 
+    def _tokenize(self, source):
+        # Returns a list of (kind, value, lineno) tuples, terminated by
+        # an 'eof' token.
+        tokens = []
+        lineno = 1
+        for match in self.TOKEN_RE.finditer(source):
+            kind = match.lastgroup
+            if kind == 'nl':
+                lineno += 1
+            elif kind == 'bad':
+                raise AssembleError('unexpected character ' + match.group(), lineno)
+            elif kind != 'ws':
+                tokens.append((kind, match.group(), lineno))
+
+        tokens.append(('eof', '', lineno))
+        return tokens
+
     def parseSource(self, builder):
         self.builder = builder
         while self._parseInstruction():
@@ -145,216 +272,225 @@ class Parser:
         self.builder.emitLabel('__end')
 
     def _match(self, want):
-        got = self.lexer.get_token()
+        got = self.tokens.advance()[1]
         if got != want:
             raise AssembleError('unexpected token, wanted ' + want + ' got ' + got)
     
+    REGISTERS = { 'r%d' % index : index for index in range(8) }
+
     def _parseRegister(self):
-        token = self.lexer.get_token()
-        if token[0] != 'r':
+        token = self.tokens.advance()[1]
+        try:
+            return self.REGISTERS[token]
+        except KeyError:
             raise AssembleError('unexpected token ' + token + ' expected register')
-        
-        id = int(token[1:])
-        if id < 0 or id > 7:
-            raise AssembleError('bad register index')
-            
-        return id
+
+    # Token kind -> radix. int() accepts the 0x prefix when the base is 16.
+    NUMBER_BASES = { 'num' : 10, 'hex' : 16 }
 
     def _parseNumber(self):
-        tok = self.lexer.get_token()
-        if len(tok) >= 2 and tok[:2] == '0x':
-            # Hex
-            return int(tok[2:], 16)
+        kind, token, lineno = self.tokens.advance()
+        try:
+            return int(token, self.NUMBER_BASES[kind])
+        except KeyError:
+            raise AssembleError('unexpected token ' + token + ' expected number')
+
+    def _parseLabel(self):
+        kind, token, lineno = self.tokens.advance()
+        if kind != 'id':
+            raise AssembleError('unexpected token ' + token + ' expected label')
+
+        return token, lineno
+
+    def _parseThreeReg(self, param):
+        # opcode reg, reg, reg
+        parseRegister = self._parseRegister
+        match = self._match
+        dest = parseRegister()
+        match(',')
+        srca = parseRegister()
+        match(',')
+        srcb = parseRegister()
+        self.builder.emitArith(param, dest, srca, srcb)
+
+    def _parseTwoReg(self, param):
+        # opcode reg, reg
+        dest = self._parseRegister()
+        self._match(',')
+        srca = self._parseRegister()
+        self.builder.emitArith(param, dest, srca, 0)
+
+    def _parseMemoryOperands(self):
+        # opcode reg, offset(reg)
+        # opcode reg, (reg)
+        destsrc = self._parseRegister()
+        self._match(',')
+        if self.tokens.peek()[1] != '(':
+            offset = self._parseNumber()
         else:
-            return int(tok) # Decimal
-
-    FORM_THREE_REG = 0
-    FORM_TWO_REG = 1
-    FORM_LOAD = 2
-    FORM_STORE = 3
-    FORM_ADDI = 4
-    FORM_LUI = 5
-    FORM_CONDITIONAL_BRANCH = 6
-    FORM_UNCONDITIONAL_BRANCH = 7
-    FORM_REG_BRANCH = 8
-    FORM_LDI = 9
-    FORM_NOP = 10
-    FORM_LEA = 11
-
+            offset = 0
+
+        self._match('(')
+        ptrreg = self._parseRegister()
+        self._match(')')
+        return destsrc, ptrreg, offset
+
+    def _parseLoad(self, param):
+        dest, ptrreg, offset = self._parseMemoryOperands()
+        self.builder.emitLoad(dest, ptrreg, offset)
+
+    def _parseStore(self, param):
+        src, ptrreg, offset = self._parseMemoryOperands()
+        self.builder.emitStore(src, ptrreg, offset)
+
+    def _parseAddi(self, param):
+        # opcode reg, reg, immediate
+        dest = self._parseRegister()
+        self._match(',')
+        opa = self._parseRegister()
+        self._match(',')
+        val = self._parseNumber()
+        self.builder.emitAddi(dest, opa, val)
+
+    def _parseLui(self, param):
+        # opcode reg, immediate
+        dest = self._parseRegister()
+        self._match(',')
+        val = self._parseNumber()
+        self.builder.emitLui(dest, val)
+
+    def _parseConditionalBranch(self, param):
+        # opcode label
+        target, lineno = self._parseLabel()
+        self.builder.emitConditionalBranch(lineno, target, param)
+
+    def _parseUnconditionalBranch(self, param):
+        # opcode target
+        target, lineno = self._parseLabel()
+        self.builder.emitUnconditionalBranch(lineno, target, param)
+
+    def _parseRegBranch(self, param):
+        # opcode reg
+        dest = self._parseRegister()
+        self.builder.emitRegisterBranch(dest, param)
+
+    def _parseLdi(self, param):
+        # pseudo op load immediate.  Build this out of LUI and/ADDI
+        dest = self._parseRegister()
+        self._match(',')
+        value = self._parseNumber()
+        if value > 0x7fff or value < -0x7fff:
+            raise AssembleError('constant out of range')
+
+        # Split into the upper bits for LUI and the low 6 bits for ADDI.
+        # The shift is arithmetic, so the low part is always positive.
+        hi = value >> 6
+        lo = value & 0x3f
+        self.builder.emitLui(dest, hi)
+        if lo != 0:
+            self.builder.emitAddi(dest, dest, lo)
+
+    def _parseNop(self, param):
+        self.builder.emitArith(0, 0, 0, 0)
+
+    def _parseLea(self, param):
+        dest = self._parseRegister()
+        self._match(',')
+        target, lineno = self._parseLabel()
+        self.builder.emitLea(lineno, dest, target)
+
+    # mnemonic -> ( parse function, parameter passed to it )
     INSTRUCTIONS = { 
-        'and' : ( FORM_THREE_REG, 0 ),
-        'or' : ( FORM_THREE_REG, 1 ),
-        'shl' : ( FORM_THREE_REG, 2 ), 
-        'shr' : ( FORM_THREE_REG, 3 ),
-        'add' : ( FORM_THREE_REG, 4 ), 
-        'sub' : ( FORM_THREE_REG, 5 ), 
-        'xor' : ( FORM_THREE_REG, 6 ),
-        'not' : ( FORM_TWO_REG, 7 ),
-        'rol' : ( FORM_TWO_REG, 10 ),
-        'ror' : ( FORM_TWO_REG, 11 ),
-        'adc' : ( FORM_THREE_REG, 12 ),
-        'sbc' : ( FORM_THREE_REG, 13 ),
-        'load' : ( FORM_LOAD, 0 ),
-        'store' : (FORM_STORE, 0 ),
-        'addi' : ( FORM_ADDI, 0 ),
-        'lui' : ( FORM_LUI, 0 ),
-        'jump' : ( FORM_UNCONDITIONAL_BRANCH, 0 ),
-        'call' : ( FORM_UNCONDITIONAL_BRANCH, 1 ),
-        'jumpr' : ( FORM_REG_BRANCH, 0 ),
-        'callr' : ( FORM_REG_BRANCH, 1 ),
-        'bcc' : ( FORM_CONDITIONAL_BRANCH, 6 ),
-        'bcs' : ( FORM_CONDITIONAL_BRANCH, 2 ),
-        'bzc' : ( FORM_CONDITIONAL_BRANCH, 4 ),
-        'bzs' : ( FORM_CONDITIONAL_BRANCH, 0 ),
-        'bnc' : ( FORM_CONDITIONAL_BRANCH, 5 ),
-        'bns' : ( FORM_CONDITIONAL_BRANCH, 1 ),
-        'boc' : ( FORM_CONDITIONAL_BRANCH, 7 ),
-        'bos' : ( FORM_CONDITIONAL_BRANCH, 3 ),
-        'ldi' : ( FORM_LDI, 0 ),
-        'nop' : ( FORM_NOP, 0 ),
-        'lea' : ( FORM_LEA, 0 )
+        'and' : ( _parseThreeReg, 0 ),
+        'or' : ( _parseThreeReg, 1 ),
+        'shl' : ( _parseThreeReg, 2 ), 
+        'shr' : ( _parseThreeReg, 3 ),
+        'add' : ( _parseThreeReg, 4 ), 
+        'sub' : ( _parseThreeReg, 5 ), 
+        'xor' : ( _parseThreeReg, 6 ),
+        'not' : ( _parseTwoReg, 7 ),
+        'rol' : ( _parseTwoReg, 10 ),
+        'ror' : ( _parseTwoReg, 11 ),
+        'adc' : ( _parseThreeReg, 12 ),
+        'sbc' : ( _parseThreeReg, 13 ),
+        'load' : ( _parseLoad, 0 ),
+        'store' : ( _parseStore, 0 ),
+        'addi' : ( _parseAddi, 0 ),
+        'lui' : ( _parseLui, 0 ),
+        'jump' : ( _parseUnconditionalBranch, 0 ),
+        'call' : ( _parseUnconditionalBranch, 1 ),
+        'jumpr' : ( _parseRegBranch, 0 ),
+        'callr' : ( _parseRegBranch, 1 ),
+        'bcc' : ( _parseConditionalBranch, 6 ),
+        'bcs' : ( _parseConditionalBranch, 2 ),
+        'bzc' : ( _parseConditionalBranch, 4 ),
+        'bzs' : ( _parseConditionalBranch, 0 ),
+        'bnc' : ( _parseConditionalBranch, 5 ),
+        'bns' : ( _parseConditionalBranch, 1 ),
+        'boc' : ( _parseConditionalBranch, 7 ),
+        'bos' : ( _parseConditionalBranch, 3 ),
+        'ldi' : ( _parseLdi, 0 ),
+        'nop' : ( _parseNop, 0 ),
+        'lea' : ( _parseLea, 0 )
     }
 
     def _parseInstruction(self):
-        global INSTRUCTIONS
-        
+        builder = self.builder
+        tokens = self.tokens
         try:
-            token = self.lexer.get_token()
-            if token == '':
+            kind, token, lineno = tokens.advance()
+            if kind == 'eof':
                 return False
         
             if token[-1] == ':':
                 # define label
-                self.builder.emitLabel(token[:-1])
+                builder.emitLabel(token[:-1])
             elif token == 'res':
                 # Reserve data words
                 while True:
-                    lookahead = self.lexer.get_token()
-                    if lookahead[0].isdigit():
+                    if tokens.peek()[0] in ('num', 'hex'):
                         # Raw data value
-                        self.lexer.push_token(lookahead)
                         value = self._parseNumber()
-                        self.builder.emitData(value)
+                        builder.emitData(value)
                     else:
                         # Label address
-                        self.builder.emitLabelDataRef(self.lexer.lineno, lookahead)
+                        target, lineno = self._parseLabel()
+                        builder.emitLabelDataRef(lineno, target)
 
-                    lookahead = self.lexer.get_token()
-                    if lookahead != ',':
-                        self.lexer.push_token(lookahead)
+                    if tokens.advance()[1] != ',':
+                        tokens.pos -= 1
                         break
             elif token == 'org':
                 address = self._parseNumber()
-                self.builder.setOrigin(address)
+                builder.setOrigin(address)
                 
             elif token in self.INSTRUCTIONS:
-                form, param = self.INSTRUCTIONS[token]
-                if form == self.FORM_THREE_REG:
-                    # opcode reg, reg, reg
-                    dest = self._parseRegister()
-                    self._match(',')
-                    srca = self._parseRegister()
-                    self._match(',')
-                    srcb = self._parseRegister()
-                    self.builder.emitArith(param, dest, srca, srcb)
-                elif form == self.FORM_TWO_REG:
-                    # opcode reg, reg
-                    dest = self._parseRegister()
-                    self._match(',')
-                    srca = self._parseRegister()
-                    self.builder.emitArith(param, dest, srca, 0)
-                elif form == self.FORM_LOAD or form == self.FORM_STORE:
-                    # opcode reg, offset(reg)
-                    # opcode reg, (reg)
-                    destsrc = self._parseRegister()
-                    self._match(',')
-                    lookahead = self.lexer.get_token()
-                    if lookahead != '(':
-                        if not lookahead.isdigit():
-                            raise AssembleError('unexpected token')
-
-                        self.lexer.push_token(lookahead)
-                        offset = self._parseNumber()
-                        self._match('(')
-                    else:
-                        offset = 0
-                    
-                    ptrreg = self._parseRegister()
-                    self._match(')')
-                    if form == self.FORM_LOAD:
-                        self.builder.emitLoad(destsrc, ptrreg, offset)
-                    else:
-                        self.builder.emitStore(destsrc, ptrreg, offset)
-                elif form == self.FORM_ADDI:
-                    # opcode reg, reg, immediate
-                    dest = self._parseRegister()
-                    self._match(',')
-                    opa = self._parseRegister()
-                    self._match(',')
-                    val = self._parseNumber()
-                    self.builder.emitAddi(dest, opa, val)
-                elif form == self.FORM_LUI:
-                    # opcode reg, immediate
-                    dest = self._parseRegister()
-                    self._match(',')
-                    val = self.lexer.get_token()
-                    self.builder.emitLui(dest, val)
-                elif form == self.FORM_CONDITIONAL_BRANCH:
-                    # opcode label
-                    target = self.lexer.get_token()
-                    self.builder.emitConditionalBranch(self.lexer.lineno, target, param)
-                elif form == self.FORM_UNCONDITIONAL_BRANCH:
-                    # opcode target
-                    target = self.lexer.get_token()
-                    self.builder.emitUnconditionalBranch(self.lexer.lineno, target, param)
-                elif form == self.FORM_REG_BRANCH:
-                    # opcode reg
-                    dest = self._parseRegister()
-                    self.builder.emitRegisterBranch(dest, param)
-                elif form == self.FORM_LDI:
-                    # pseudo op load immediate.  Build this out of LUI and/ADDI
-                    dest = self._parseRegister()
-                    self._match(',')
-                    value = self._parseNumber()
-                    if value > 0x7fff or value < -0x7fff:
-                        raise AssembleError('constant out of range')
-
-                    self.builder.emitLui(dest, value / 64)
-                    if (value & 0x1f) != 0:
-                        self.builder.emitAddi(dest, dest, value % 64)
-                elif form == self.FORM_NOP:
-                    self.builder.emitArith(0, 0, 0, 0)
-                elif form == self.FORM_LEA:
-                    dest = self._parseRegister()
-                    self._match(',')
-                    target = self.lexer.get_token()
-                    self.builder.emitLea(self.lexer.lineno, dest, target)
-                else:
-                    raise AssembleError('internal error: unknown instruction format')
+                parseFunc, param = self.INSTRUCTIONS[token]
+                parseFunc(self, param)
             else:
                 raise AssembleError('bad instruction' + token)  
         except AssembleError as e:
-            e.lineno = self.lexer.lineno
+            if e.lineno == -1:
+                e.lineno = tokens.getLineno()
+
             raise
 
         return True
 
-if len(sys.argv) != 3:
-    print 'Usage: assemble <output file> <input file>'
-    sys.exit(1)
-
-builder = CodeBuilder()
-
-inputFile = open(sys.argv[2], 'r')
-parser = Parser(inputFile)
-parser.parseSource(builder)
-inputFile.close()
-
-builder.doFixups()
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: assemble <output file> <input file>')
+        sys.exit(1)
 
-outputFile = open(sys.argv[1], 'w')
-builder.dumpHex(outputFile)
-outputFile.close()
+    builder = CodeBuilder()
 
+    inputFile = open(sys.argv[2], 'r')
+    parser = Parser(inputFile)
+    inputFile.close()
+    parser.parseSource(builder)
 
+    builder.doFixups()
 
+    outputFile = open(sys.argv[1], 'w')
+    builder.dumpHex(outputFile)
+    outputFile.close()